@@ -14,11 +14,11 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from typing import Type, Tuple, List
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone, tzinfo
 from html import escape
+import functools
 import asyncio
-
-import pytz
+import re
 
 from mautrix.types import (EventType, RedactionEvent, StateEvent, Format, MessageType,
                            TextMessageEventContent, ReactionEvent, UserID)
@@ -28,16 +28,32 @@ from maubot import Plugin, MessageEvent
 from maubot.handlers import command, event
 
 from .db import ReminderDatabase
-from .util import Config, ReminderInfo, DateArgument, parse_timezone, format_time
+from .util import (Config, ReminderInfo, DateArgument, ZoneInfo, ZoneInfoNotFoundError,
+                   load_timezone, parse_timezone, format_time)
 from .locales import locales
 
+user_link_template = "<a href='https://matrix.to/#/{0}'>{0}</a>"
+# Reminder messages only go in text nodes, so quotes don't need to be escaped like html.escape does
+text_escape_table = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+thumbs_up_regex = re.compile(r"\U0001F44D[\U0001F3FB-\U0001F3FF]?")
+
+
+@functools.lru_cache(maxsize=256)
+def format_mentions(users: Tuple[UserID, ...]) -> Tuple[str, str]:
+    return (" ".join(users),
+            " ".join([user_link_template.format(escape(user_id)) for user_id in users]))
+
 
 class ReminderBot(Plugin):
     db: ReminderDatabase
     reminder_loop_task: asyncio.Future
+    reminder_loop_wake: asyncio.Event
+    send_semaphore: asyncio.Semaphore
+    scheduled_until: datetime
     base_command: str
     base_aliases: Tuple[str, ...]
-    default_timezone: pytz.timezone
+    help_text: str
+    default_timezone: tzinfo
 
     @classmethod
     def get_config_class(cls) -> Type[BaseProxyConfig]:
@@ -46,6 +62,10 @@ class ReminderBot(Plugin):
     async def start(self) -> None:
         self.on_external_config_update()
         self.db = ReminderDatabase(self.database)
+        self.reminder_loop_wake = asyncio.Event()
+        # Limit concurrent sends so that a burst of reminders doesn't flood the homeserver
+        self.send_semaphore = asyncio.Semaphore(16)
+        self.scheduled_until = datetime.now(tz=timezone.utc).replace(microsecond=0)
         self.reminder_loop_task = asyncio.create_task(self.reminder_loop())
 
     def on_external_config_update(self) -> None:
@@ -53,12 +73,25 @@ class ReminderBot(Plugin):
         bc = self.config["base_command"]
         self.base_command = bc[0] if isinstance(bc, list) else bc
         self.base_aliases = tuple(bc) if isinstance(bc, list) else (bc,)
+        self.help_text = (
+            f"Maubot [Reminder](https://github.com/maubot/reminder) plugin.\n\n"
+            f"* !{self.base_command} <date> <message> - Add a reminder\n"
+            f"* !{self.base_command} again <date> - Reply to a reminder to reschedule it\n"
+            f"* !{self.base_command} list - Get a list of your reminders\n"
+            f"* !{self.base_command} tz <timezone> - Set your time zone\n"
+            f"* !{self.base_command} locale <locale> - Set your locale\n"
+            f"* !{self.base_command} locales - List available locales\n\n"
+            "<date> can be a time delta (e.g. `2 days 1.5 hours` or `friday at 15:00`) "
+            "or an absolute date (e.g. `2020-03-27 15:00`)\n\n"
+            "To get mentioned by a reminder added by someone else, upvote the message "
+            "by reacting with \U0001F44D.\n\n"
+            "To cancel a reminder, remove the message or reaction.")
         raw_timezone = self.config["default_timezone"]
         try:
-            self.default_timezone = pytz.timezone(raw_timezone)
-        except pytz.UnknownTimeZoneError:
+            self.default_timezone = load_timezone(raw_timezone)
+        except (ZoneInfoNotFoundError, ValueError):
             self.log.warning(f"Unknown default timezone {raw_timezone}")
-            self.default_timezone = pytz.UTC
+            self.default_timezone = timezone.utc
 
     async def stop(self) -> None:
         self.reminder_loop_task.cancel()
@@ -67,18 +100,31 @@ class ReminderBot(Plugin):
         try:
             self.log.debug("Reminder loop started")
             while True:
-                now = datetime.now(tz=pytz.UTC)
-                next_minute = (now + timedelta(minutes=1)).replace(second=0, microsecond=0)
-                await asyncio.sleep((next_minute - now).total_seconds())
-                await self.schedule_nearby_reminders(next_minute)
+                # Clear before querying so that reminders inserted while we're busy still wake us
+                self.reminder_loop_wake.clear()
+                now = datetime.now(tz=timezone.utc)
+                until = now.replace(microsecond=0) + timedelta(seconds=1)
+                if until > self.scheduled_until:
+                    await self.schedule_nearby_reminders(self.scheduled_until, until)
+                    self.scheduled_until = until
+                # Sleep until the next reminder is due, but wake up at least once an hour anyway
+                wait = 60 * 60
+                next_date = self.db.next_reminder_date(self.scheduled_until)
+                if next_date:
+                    wait = min((next_date - now).total_seconds(), wait)
+                try:
+                    await asyncio.wait_for(self.reminder_loop_wake.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
         except asyncio.CancelledError:
             self.log.debug("Reminder loop stopped")
         except Exception:
             self.log.exception("Exception in reminder loop")
 
-    async def schedule_nearby_reminders(self, now: datetime) -> None:
-        until = now + timedelta(minutes=1)
-        for reminder in self.db.all_in_range(now, until):
+    async def schedule_nearby_reminders(self, after: datetime, until: datetime) -> None:
+        for reminder in self.db.all_in_range(after, until):
+            # Reactions and redactions can't affect the reminder after this point
+            self.db.forget_event_ids(reminder)
             background_task.create(self.send_reminder(reminder))
 
     async def send_reminder(self, reminder: ReminderInfo) -> None:
@@ -91,18 +137,21 @@ class ReminderBot(Plugin):
         if len(reminder.users) == 0:
             self.log.debug(f"Cancelling reminder {reminder}, no users left to remind")
             return
-        wait = (reminder.date - datetime.now(tz=pytz.UTC)).total_seconds()
-        if wait > 0:
+        wait = (reminder.date - datetime.now(tz=timezone.utc)).total_seconds()
+        # Don't bother scheduling a timer for reminders that are due within a millisecond
+        if wait > 0.001:
             self.log.debug(f"Waiting {wait} seconds to send {reminder}")
             await asyncio.sleep(wait)
         else:
             self.log.debug(f"Sending {reminder} immediately")
-        users = " ".join(reminder.users)
-        users_html = " ".join(f"<a href='https://matrix.to/#/{user_id}'>{user_id}</a>"
-                              for user_id in reminder.users)
+        async with self.send_semaphore:
+            await self._send_reminder_message(reminder)
+
+    async def _send_reminder_message(self, reminder: ReminderInfo) -> None:
+        users, users_html = format_mentions(tuple(reminder.users))
         content = TextMessageEventContent(
             msgtype=MessageType.TEXT, body=f"{users}: {reminder.message}", format=Format.HTML,
-            formatted_body=f"{users_html}: {escape(reminder.message)}")
+            formatted_body=f"{users_html}: {reminder.message.translate(text_escape_table)}")
         content["xyz.maubot.reminder"] = {
             "id": reminder.id,
             "message": reminder.message,
@@ -120,7 +169,7 @@ class ReminderBot(Plugin):
     @command.argument("message", pass_raw=True, required=False)
     async def remind(self, evt: MessageEvent, date: datetime, message: str) -> None:
         date = date.replace(microsecond=0)
-        now = datetime.now(tz=pytz.UTC).replace(microsecond=0)
+        now = datetime.now(tz=timezone.utc).replace(microsecond=0)
         if date < now:
             await evt.reply(f"Sorry, {date} is in the past and I don't have a time machine :(")
             return
@@ -136,7 +185,7 @@ class ReminderBot(Plugin):
             await evt.reply("You must reply to a reminder event to reschedule it.")
             return
         date = date.replace(microsecond=0)
-        now = datetime.now(tz=pytz.UTC).replace(microsecond=0)
+        now = datetime.now(tz=timezone.utc).replace(microsecond=0)
         if date < now:
             await evt.reply(f"Sorry, {date} is in the past and I don't have a time machine :(")
             return
@@ -173,25 +222,16 @@ class ReminderBot(Plugin):
                f"(others can \U0001F44D this message to get pinged too)")
         rem.event_id = await evt.reply(msg)
         self.db.insert(rem)
-        now = datetime.now(tz=pytz.UTC)
-        if (rem.date - now).total_seconds() < 60 and now.minute == rem.date.minute:
-            self.log.debug(f"Reminder {rem} is in less than a minute, scheduling now...")
+        if rem.date < self.scheduled_until:
+            self.log.debug(f"Reminder {rem} was already due, scheduling now...")
+            self.db.forget_event_ids(rem)
             background_task.create(self.send_reminder(rem))
+        else:
+            self.reminder_loop_wake.set()
 
     @remind.subcommand("help", help="Usage instructions")
     async def help(self, evt: MessageEvent) -> None:
-        await evt.reply(f"Maubot [Reminder](https://github.com/maubot/reminder) plugin.\n\n"
-                        f"* !{self.base_command} <date> <message> - Add a reminder\n"
-                        f"* !{self.base_command} again <date> - Reply to a reminder to reschedule it\n"
-                        f"* !{self.base_command} list - Get a list of your reminders\n"
-                        f"* !{self.base_command} tz <timezone> - Set your time zone\n"
-                        f"* !{self.base_command} locale <locale> - Set your locale\n"
-                        f"* !{self.base_command} locales - List available locales\n\n"
-                        "<date> can be a time delta (e.g. `2 days 1.5 hours` or `friday at 15:00`) "
-                        "or an absolute date (e.g. `2020-03-27 15:00`)\n\n"
-                        "To get mentioned by a reminder added by someone else, upvote the message "
-                        "by reacting with \U0001F44D.\n\n"
-                        "To cancel a reminder, remove the message or reaction.")
+        await evt.reply(self.help_text)
 
     @remind.subcommand("list", help="List your reminders")
     @command.argument("all", required=False)
@@ -210,8 +250,11 @@ class ReminderBot(Plugin):
             else:
                 return f'"{rem.message}"'
 
-        reminders_str = "\n".join(f"* {format_rem(reminder)} {self.format_time(evt.sender, reminder)}"
-                                  for reminder in self.db.all_for_user(evt.sender, room_id=room_id))
+        tz = self.db.get_timezone(evt.sender, self.default_timezone)
+        now = datetime.now(tz=timezone.utc).replace(microsecond=0)
+        reminders_str = "\n".join(
+            f"* {format_rem(reminder)} {format_time(reminder.date.astimezone(tz), now)}"
+            for reminder in self.db.all_for_user(evt.sender, room_id=room_id))
         message = "upcoming reminders"
         if room_id:
             message += " in this room"
@@ -221,7 +264,8 @@ class ReminderBot(Plugin):
             await evt.reply(f"Your {message}:\n\n{reminders_str}")
 
     def format_time(self, sender: UserID, reminder: ReminderInfo) -> str:
-        return format_time(reminder.date.astimezone(self.db.get_timezone(sender)))
+        tz = self.db.get_timezone(sender, self.default_timezone)
+        return format_time(reminder.date.astimezone(tz))
 
     @remind.subcommand("locales", help="List available locales")
     async def locales(self, evt: MessageEvent) -> None:
@@ -249,33 +293,40 @@ class ReminderBot(Plugin):
         if not locale:
             await evt.reply(f"Your locale is {self._fmt_locales(self.db.get_locales(evt.sender))}")
             return
-        locale_ids = [part.strip() for part in locale.lower().split(" ")]
-        for locale_id in locale_ids:
+        locale_ids = []
+        for part in locale.split():
+            locale_id = part.casefold()
             if locale_id not in locales:
                 await evt.reply(f"Locale `{locale_id}` is not supported")
                 return
+            locale_ids.append(locale_id)
         self.db.set_locales(evt.sender, locale_ids)
         await evt.reply(f"Set your locale to {self._fmt_locales(locale_ids)}")
 
     @remind.subcommand("timezone", help="Set your timezone", aliases=("tz",))
     @command.argument("timezone", parser=parse_timezone, required=False)
-    async def timezone(self, evt: MessageEvent, timezone: pytz.timezone) -> None:
+    async def timezone(self, evt: MessageEvent, timezone: ZoneInfo) -> None:
         if not timezone:
-            await evt.reply(f"Your time zone is {self.db.get_timezone(evt.sender).zone}")
+            tz = self.db.get_timezone(evt.sender, self.default_timezone)
+            await evt.reply(f"Your time zone is {tz}")
             return
         self.db.set_timezone(evt.sender, timezone)
-        await evt.reply(f"Set your timezone to {timezone.zone}")
+        await evt.reply(f"Set your timezone to {timezone.key}")
 
-    @command.passive(regex=r"(?:\U0001F44D[\U0001F3FB-\U0001F3FF]?)",
+    @command.passive(regex=thumbs_up_regex,
                      field=lambda evt: evt.content.relates_to.key,
                      event_type=EventType.REACTION, msgtypes=None)
     async def subscribe_react(self, evt: ReactionEvent, _: Tuple[str]) -> None:
+        if evt.content.relates_to.event_id not in self.db.event_id_cache:
+            return
         reminder = self.db.get_by_event_id(evt.content.relates_to.event_id)
         if reminder:
             self.db.add_user(reminder, evt.sender, evt.event_id)
 
     @event.on(EventType.ROOM_REDACTION)
     async def redact(self, evt: RedactionEvent) -> None:
+        if evt.redacts not in self.db.event_id_cache:
+            return
         self.db.redact_event(evt.redacts)
 
     @event.on(EventType.ROOM_TOMBSTONE)
@@ -13,29 +13,33 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, Iterator, Dict, List
-from datetime import datetime
+from typing import Optional, Iterator, Dict, List, Set
+from datetime import datetime, timezone, tzinfo
 
-import pytz
 from sqlalchemy import (Column, String, Integer, Text, DateTime, ForeignKey, Table, MetaData,
-                        select, and_)
+                        Index, select, and_, or_, func, inspect, bindparam)
 from sqlalchemy.engine.base import Engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.expression import Select, Insert
+from sqlalchemy.util import LRUCache
 
 from mautrix.types import UserID, EventID, RoomID
 
-from .util import ReminderInfo
+from .util import ReminderInfo, ZoneInfo, ZoneInfoNotFoundError, load_timezone
 
 
 class ReminderDatabase:
     reminder: Table
     reminder_target: Table
     timezone: Table
-    tz_cache: Dict[UserID, pytz.timezone]
+    tz_cache: Dict[UserID, Optional[tzinfo]]
     locale_cache: Dict[UserID, List[str]]
+    event_id_cache: Set[EventID]
     db: Engine
 
     def __init__(self, db: Engine) -> None:
-        self.db = db
+        # The queries below are built once, so let SQLAlchemy reuse their compiled forms too
+        self.db = db.execution_options(compiled_cache=LRUCache(100))
         self.tz_cache = {}
         self.locale_cache = {}
 
@@ -48,13 +52,17 @@ class ReminderDatabase:
                               Column("room_id", String(255), nullable=False),
                               Column("event_id", String(255), nullable=False),
                               Column("message", Text, nullable=False),
-                              Column("reply_to", String(255), nullable=True))
+                              Column("reply_to", String(255), nullable=True),
+                              Index("reminder_date_idx", "date"),
+                              Index("reminder_event_id_idx", "event_id"))
         self.reminder_target = Table("reminder_target", meta,
                                      Column("reminder_id", Integer,
                                             ForeignKey("reminder.id", ondelete="CASCADE"),
                                             primary_key=True),
                                      Column("user_id", String(255), primary_key=True),
-                                     Column("event_id", String(255), nullable=False))
+                                     Column("event_id", String(255), nullable=False),
+                                     Index("reminder_target_user_id_idx", "user_id"),
+                                     Index("reminder_target_event_id_idx", "event_id"))
         self.timezone = Table("timezone", meta,
                               Column("user_id", String(255), primary_key=True),
                               Column("timezone", String(255), nullable=False))
@@ -63,138 +71,233 @@ class ReminderDatabase:
                             Column("locales", String(255), nullable=False))
 
         meta.create_all()
+        # create_all() only creates indexes along with new tables, so add them to old ones here
+        for table in meta.sorted_tables:
+            self._create_missing_indexes(table)
+        self._prepare_statements()
+        self._load_event_ids()
 
-    def set_timezone(self, user_id: UserID, tz: pytz.timezone) -> None:
-        with self.db.begin() as tx:
-            tx.execute(self.timezone.delete().where(self.timezone.c.user_id == user_id))
-            tx.execute(self.timezone.insert().values(user_id=user_id, timezone=tz.zone))
+    def _create_missing_indexes(self, table: Table) -> None:
+        existing = {index["name"] for index in inspect(self.db).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(self.db)
+
+    def _load_event_ids(self) -> None:
+        now = datetime.now(tz=timezone.utc)
+        reminder_rows = self.db.execute(select([self.reminder.c.event_id])
+                                        .where(self.reminder.c.date > now))
+        target_rows = self.db.execute(select([self.reminder_target.c.event_id])
+                                      .where(and_(self.reminder_target.c.reminder_id
+                                                  == self.reminder.c.id,
+                                                  self.reminder.c.date > now)))
+        self.event_id_cache = {row[0] for row in reminder_rows}
+        self.event_id_cache.update(row[0] for row in target_rows)
+
+    def forget_event_ids(self, reminder: ReminderInfo) -> None:
+        self.event_id_cache.discard(reminder.event_id)
+        if isinstance(reminder.users, dict):
+            self.event_id_cache.difference_update(reminder.users.values())
+
+    def _prepare_statements(self) -> None:
+        self.get_stmt = self._select_with_users(self.reminder.c.id == bindparam("id"))
+        # The event ID can be either the reminder's own event or the event of one of its targets.
+        # Targets are matched through a subquery so that all users of the reminder are returned.
+        target_reminder_ids = (select([self.reminder_target.c.reminder_id])
+                               .where(self.reminder_target.c.event_id == bindparam("event_id")))
+        self.get_by_event_id_stmt = self._select_with_users(
+            or_(self.reminder.c.event_id == bindparam("event_id"),
+                self.reminder.c.id.in_(target_reminder_ids)))
+        # This can return lots of rows, so stream them with a server-side cursor where the
+        # driver supports it (e.g. psycopg2) instead of buffering the whole result.
+        self.all_stmt = self._select_with_users(None).execution_options(stream_results=True)
+        in_range = and_(self.reminder.c.date >= bindparam("after"),
+                        self.reminder.c.date < bindparam("before"))
+        self.all_in_range_stmt = self._select_with_users(in_range)
+        user_reminders = and_(self.reminder.c.id == self.reminder_target.c.reminder_id,
+                              self.reminder_target.c.user_id == bindparam("user_id"),
+                              self.reminder.c.date > bindparam("now"))
+        self.all_for_user_stmt = select([self.reminder]).where(user_reminders)
+        self.all_for_user_in_room_stmt = (select([self.reminder])
+                                          .where(and_(user_reminders, self.reminder.c.room_id
+                                                      == bindparam("room_id"))))
+        self.next_date_stmt = (select([func.min(self.reminder.c.date)])
+                               .where(self.reminder.c.date >= bindparam("after")))
+        self.insert_stmt = self.reminder.insert()
+        self.insert_target_stmt = self.reminder_target.insert()
+        self.update_room_id_stmt = (self.reminder.update()
+                                    .where(self.reminder.c.room_id == bindparam("old_room_id"))
+                                    .values(room_id=bindparam("new_room_id")))
+        self.redact_stmt = (self.reminder_target.delete()
+                            .where(self.reminder_target.c.event_id == bindparam("event_id")))
+        self.remove_user_stmt = (self.reminder_target.delete()
+                                 .where(and_(self.reminder_target.c.reminder_id
+                                             == bindparam("reminder_id"),
+                                             self.reminder_target.c.user_id
+                                             == bindparam("user_id"))))
+
+        self.get_timezone_stmt = (select([self.timezone.c.timezone])
+                                  .where(self.timezone.c.user_id == bindparam("user_id")))
+        self.delete_timezone_stmt = (self.timezone.delete()
+                                     .where(self.timezone.c.user_id == bindparam("user_id")))
+        self.insert_timezone_stmt = self.timezone.insert()
+        self.upsert_timezone_stmt = self._upsert_stmt(self.timezone)
+        self.get_locales_stmt = (select([self.locale.c.locales])
+                                 .where(self.locale.c.user_id == bindparam("user_id")))
+        self.delete_locales_stmt = (self.locale.delete()
+                                    .where(self.locale.c.user_id == bindparam("user_id")))
+        self.insert_locales_stmt = self.locale.insert()
+        self.upsert_locales_stmt = self._upsert_stmt(self.locale)
+
+    def _upsert_stmt(self, table: Table) -> Optional[Insert]:
+        # Returns None if the dialect doesn't have an upsert, callers fall back to delete+insert
+        dialect = self.db.dialect.name
+        if dialect == "postgresql":
+            stmt = postgresql.insert(table)
+            return stmt.on_conflict_do_update(
+                index_elements=[table.c.user_id],
+                set_={col.name: stmt.excluded[col.name] for col in table.c if not col.primary_key})
+        elif dialect == "sqlite":
+            return table.insert().prefix_with("OR REPLACE")
+        return None
+
+    def _select_with_users(self, whereclause) -> Select:
+        # This is an inner join, so reminders with no users left are never returned
+        join = self.reminder_target.c.reminder_id == self.reminder.c.id
+        return (select([self.reminder, self.reminder_target.c.user_id,
+                        self.reminder_target.c.event_id])
+                .where(and_(join, whereclause) if whereclause is not None else join)
+                .order_by(self.reminder.c.date, self.reminder.c.id))
+
+    def set_timezone(self, user_id: UserID, tz: ZoneInfo) -> None:
+        if self.upsert_timezone_stmt is not None:
+            self.db.execute(self.upsert_timezone_stmt, user_id=user_id, timezone=tz.key)
+        else:
+            with self.db.begin() as tx:
+                tx.execute(self.delete_timezone_stmt, user_id=user_id)
+                tx.execute(self.insert_timezone_stmt, user_id=user_id, timezone=tz.key)
         self.tz_cache[user_id] = tz
 
-    def get_timezone(self, user_id: UserID, default_tz: Optional[pytz.timezone] = None
-                     ) -> Optional[pytz.timezone]:
+    def get_timezone(self, user_id: UserID, default_tz: Optional[tzinfo] = None
+                     ) -> tzinfo:
         try:
-            return self.tz_cache[user_id]
+            tz = self.tz_cache[user_id]
         except KeyError:
-            rows = self.db.execute(select([self.timezone.c.timezone])
-                                   .where(self.timezone.c.user_id == user_id))
+            tz_name = self.db.execute(self.get_timezone_stmt, user_id=user_id).scalar()
             try:
-                self.tz_cache[user_id] = pytz.timezone(next(rows)[0])
-            except (pytz.UnknownTimeZoneError, StopIteration, IndexError):
-                self.tz_cache[user_id] = default_tz or pytz.UTC
-            return self.tz_cache[user_id]
+                tz = load_timezone(tz_name) if tz_name else None
+            except (ZoneInfoNotFoundError, ValueError):
+                tz = None
+            # Users without a timezone are cached as None so that the default can still change
+            self.tz_cache[user_id] = tz
+        return tz or default_tz or timezone.utc
 
     def set_locales(self, user_id: UserID, locales: List[str]) -> None:
-        with self.db.begin() as tx:
-            tx.execute(self.locale.delete().where(self.locale.c.user_id == user_id))
-            tx.execute(self.locale.insert().values(user_id=user_id, locales=",".join(locales)))
+        if self.upsert_locales_stmt is not None:
+            self.db.execute(self.upsert_locales_stmt, user_id=user_id, locales=",".join(locales))
+        else:
+            with self.db.begin() as tx:
+                tx.execute(self.delete_locales_stmt, user_id=user_id)
+                tx.execute(self.insert_locales_stmt, user_id=user_id, locales=",".join(locales))
         self.locale_cache[user_id] = locales
 
     def get_locales(self, user_id: UserID) -> List[str]:
         try:
             return self.locale_cache[user_id]
         except KeyError:
-            rows = self.db.execute(select([self.locale.c.locales])
-                                   .where(self.locale.c.user_id == user_id))
-            try:
-                self.locale_cache[user_id] = next(rows)[0].split(",")
-            except (StopIteration, IndexError):
-                self.locale_cache[user_id] = ["en_iso"]
+            locales = self.db.execute(self.get_locales_stmt, user_id=user_id).scalar()
+            self.locale_cache[user_id] = locales.split(",") if locales else ["en_iso"]
             return self.locale_cache[user_id]
 
     def all_for_user(self, user_id: UserID, room_id: Optional[RoomID] = None
                      ) -> Iterator[ReminderInfo]:
-        where = [self.reminder.c.id == self.reminder_target.c.reminder_id,
-                 self.reminder_target.c.user_id == user_id,
-                 self.reminder.c.date > datetime.now(tz=pytz.UTC)]
+        now = datetime.now(tz=timezone.utc)
         if room_id:
-            where.append(self.reminder.c.room_id == room_id)
-        rows = self.db.execute(select([self.reminder]).where(and_(*where)))
-        for row in rows:
-            yield ReminderInfo(id=row[0], date=row[1].replace(tzinfo=pytz.UTC), room_id=row[2],
-                               event_id=row[3], message=row[4], reply_to=row[5], users=[user_id])
+            rows = self.db.execute(self.all_for_user_in_room_stmt, user_id=user_id, now=now,
+                                   room_id=room_id)
+        else:
+            rows = self.db.execute(self.all_for_user_stmt, user_id=user_id, now=now)
+        for id, date, room_id, event_id, message, reply_to in rows:
+            yield ReminderInfo(id=id, date=date.replace(tzinfo=timezone.utc), room_id=room_id,
+                               event_id=event_id, message=message, reply_to=reply_to,
+                               users=[user_id])
 
     def get(self, id: int) -> Optional[ReminderInfo]:
-        return self._get_one(self.reminder.c.id == id)
+        return self._get_one(self.get_stmt, id=id)
 
     def get_by_event_id(self, event_id: EventID) -> Optional[ReminderInfo]:
-        reminder = self._get_one(self.reminder.c.event_id == event_id)
-        if reminder:
-            return reminder
-        rows = self.db.execute(select([self.reminder_target.c.reminder_id])
-                               .where(self.reminder_target.c.event_id == event_id))
-        try:
-            reminder_id = int(next(rows)[0])
-            return self.get(reminder_id)
-        except (StopIteration, IndexError, ValueError):
-            return None
+        return self._get_one(self.get_by_event_id_stmt, event_id=event_id)
 
-    def _get_one(self, whereclause) -> Optional[ReminderInfo]:
-        rows = self.db.execute(select([self.reminder, self.reminder_target.c.user_id,
-                                       self.reminder_target.c.event_id]).where(
-            and_(whereclause, self.reminder_target.c.reminder_id == self.reminder.c.id)))
+    def _get_one(self, stmt: Select, **params) -> Optional[ReminderInfo]:
+        rows = self.db.execute(stmt, **params)
         try:
-            first_row = next(rows)
+            id, date, room_id, event_id, message, reply_to, user_id, target_event_id = next(rows)
         except StopIteration:
             return None
-        info = ReminderInfo(id=first_row[0], date=first_row[1].replace(tzinfo=pytz.UTC),
-                            room_id=first_row[2], event_id=first_row[3], message=first_row[4],
-                            reply_to=first_row[5], users={first_row[6]: first_row[7]})
+        info = ReminderInfo(id=id, date=date.replace(tzinfo=timezone.utc), room_id=room_id,
+                            event_id=event_id, message=message, reply_to=reply_to,
+                            users={user_id: target_event_id})
+        add_user = info.users.__setitem__
         for row in rows:
-            info.users[row[6]] = row[7]
+            add_user(row[6], row[7])
         return info
 
-    def _get_many(self, whereclause) -> Iterator[ReminderInfo]:
-        rows = self.db.execute(select([self.reminder, self.reminder_target.c.user_id,
-                                       self.reminder_target.c.event_id])
-                               .where(whereclause)
-                               .order_by(self.reminder.c.id, self.reminder.c.date))
+    def _get_many(self, stmt: Select, **params) -> Iterator[ReminderInfo]:
+        rows = self.db.execute(stmt, **params)
         building_reminder = None
-        for row in rows:
+        building_id = add_user = None
+        # Unpacking each row once is cheaper than indexing the row proxy for every column
+        for id, date, room_id, event_id, message, reply_to, user_id, target_event_id in rows:
+            if id == building_id:
+                add_user(user_id, target_event_id)
+                continue
             if building_reminder is not None:
-                if building_reminder.id == row[0]:
-                    building_reminder.users[row[6]] = row[7]
-                    continue
                 yield building_reminder
-            building_reminder = ReminderInfo(id=row[0], date=row[1].replace(tzinfo=pytz.UTC),
-                                             room_id=row[2], event_id=row[3], message=row[4],
-                                             reply_to=row[5], users={row[6]: row[7]})
+            users = {user_id: target_event_id}
+            add_user = users.__setitem__
+            building_id = id
+            building_reminder = ReminderInfo(id=id, date=date.replace(tzinfo=timezone.utc),
+                                             room_id=room_id, event_id=event_id, message=message,
+                                             reply_to=reply_to, users=users)
         if building_reminder is not None:
             yield building_reminder
 
     def all(self) -> Iterator[ReminderInfo]:
-        yield from self._get_many(self.reminder_target.c.reminder_id == self.reminder.c.id)
+        yield from self._get_many(self.all_stmt)
 
     def all_in_range(self, after: datetime, before: datetime) -> Iterator[ReminderInfo]:
-        yield from self._get_many(and_(self.reminder_target.c.reminder_id == self.reminder.c.id,
-                                       after <= self.reminder.c.date,
-                                       self.reminder.c.date < before))
+        yield from self._get_many(self.all_in_range_stmt, after=after, before=before)
+
+    def next_reminder_date(self, after: datetime) -> Optional[datetime]:
+        date = self.db.execute(self.next_date_stmt, after=after).scalar()
+        return date.replace(tzinfo=timezone.utc) if date else None
 
     def insert(self, reminder: ReminderInfo) -> None:
         with self.db.begin() as tx:
-            res = tx.execute(self.reminder.insert()
-                             .values(date=reminder.date, room_id=reminder.room_id,
-                                     event_id=reminder.event_id, message=reminder.message,
-                                     reply_to=reminder.reply_to))
+            res = tx.execute(self.insert_stmt, date=reminder.date, room_id=reminder.room_id,
+                             event_id=reminder.event_id, message=reminder.message,
+                             reply_to=reminder.reply_to)
             reminder.id = res.inserted_primary_key[0]
-            tx.execute(self.reminder_target.insert(),
+            tx.execute(self.insert_target_stmt,
                        [{"reminder_id": reminder.id, "user_id": user_id,
                          "event_id": event_id}
                         for user_id, event_id in reminder.users.items()])
+        self.event_id_cache.add(reminder.event_id)
+        self.event_id_cache.update(reminder.users.values())
 
     def update_room_id(self, old: RoomID, new: RoomID) -> None:
-        self.db.execute(self.reminder.update()
-                        .where(self.reminder.c.room_id == old)
-                        .values(room_id=new))
+        self.db.execute(self.update_room_id_stmt, old_room_id=old, new_room_id=new)
 
     def redact_event(self, event_id: EventID) -> None:
-        self.db.execute(self.reminder_target.delete()
-                        .where(self.reminder_target.c.event_id == event_id))
+        self.db.execute(self.redact_stmt, event_id=event_id)
+        self.event_id_cache.discard(event_id)
 
     def add_user(self, reminder: ReminderInfo, user_id: UserID, event_id: EventID) -> bool:
         if user_id in reminder.users:
             return False
-        self.db.execute(self.reminder_target.insert()
-                        .values(reminder_id=reminder.id, user_id=user_id, event_id=event_id))
+        self.db.execute(self.insert_target_stmt,
+                        reminder_id=reminder.id, user_id=user_id, event_id=event_id)
+        self.event_id_cache.add(event_id)
         if isinstance(reminder.users, list):
             reminder.users.append(user_id)
         elif isinstance(reminder.users, dict):
@@ -204,8 +307,9 @@ class ReminderDatabase:
     def remove_user(self, reminder: ReminderInfo, user_id: UserID) -> bool:
         if user_id not in reminder.users:
             return False
-        self.db.execute(self.reminder_target.delete().where(
-            and_(self.reminder_target.c.reminder_id == reminder.id,
-                 self.reminder_target.c.user_id == user_id)))
-        reminder.users.remove(user_id)
+        self.db.execute(self.remove_user_stmt, reminder_id=reminder.id, user_id=user_id)
+        if isinstance(reminder.users, list):
+            reminder.users.remove(user_id)
+        elif isinstance(reminder.users, dict):
+            del reminder.users[user_id]
         return True
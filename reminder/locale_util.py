@@ -13,9 +13,10 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import NamedTuple, Union, Pattern, Match, Dict, Type, Optional, TYPE_CHECKING
+from typing import NamedTuple, Union, Pattern, Match, Dict, Tuple, Type, Optional, TYPE_CHECKING
 from datetime import datetime
 from abc import ABC, abstractmethod
+import functools
 import re
 
 from dateutil.relativedelta import MO
@@ -51,19 +52,33 @@ if TYPE_CHECKING:
         nlyearday: int
 
 
+# Matchers are called for every date argument, so MatcherReturns are created with positional
+# arguments, which is noticeably cheaper than passing the fields as keyword arguments.
 class MatcherReturn(NamedTuple):
     params: 'RelativeDeltaParams'
     unconsumed: str
 
 
+@functools.lru_cache(maxsize=None)
+def compile_pattern(pattern: str) -> Pattern:
+    # Locales built with Locale.replace() share most of their patterns, so make sure each
+    # distinct pattern is only compiled once instead of relying on re's own bounded cache.
+    return re.compile(pattern, re.IGNORECASE)
+
+
 class Matcher(ABC):
+    __slots__ = ()
+
     @abstractmethod
-    def match(self, val: str) -> Optional[MatcherReturn]:
+    def match(self, val: str, now: Optional[datetime] = None) -> Optional[MatcherReturn]:
         pass
 
 
 def int_or_float(val: str) -> Union[int, float]:
-    if "," in val:
+    # Plain unsigned integers are the common case, so check for them first.
+    if val.isdecimal():
+        return int(val)
+    elif "," in val:
         return float(val.replace(",", "."))
     elif "." in val:
         return float(val)
@@ -71,34 +86,55 @@ def int_or_float(val: str) -> Union[int, float]:
 
 
 class RegexMatcher(Matcher):
+    __slots__ = ("regex", "value_type", "group_names")
+
     regex: Pattern
     value_type: Type
+    group_names: Tuple[str, ...]
 
     def __init__(self, pattern: str, value_type: Type = int_or_float) -> None:
-        self.regex = re.compile(pattern, re.IGNORECASE)
+        self.regex = compile_pattern(pattern)
         self.value_type = value_type
+        self.group_names = tuple(self.regex.groupindex)
 
-    def match(self, val: str) -> Optional[MatcherReturn]:
+    def match(self, val: str, now: Optional[datetime] = None) -> Optional[MatcherReturn]:
         match = self.regex.match(val)
-        if match and match.end() > 0 and len(match.groups()) > 0:
-            return MatcherReturn(params=self._convert_match(match), unconsumed=val[match.end():])
+        if match and match.end() > 0 and self.regex.groups > 0:
+            return MatcherReturn(self._convert_match(match, now), val[match.end():])
         return None
 
-    def _convert_match(self, match: Match) -> 'RelativeDeltaParams':
-        return self._convert_groups(match.groupdict())
-
-    def _convert_groups(self, groups: Dict[str, str]) -> 'RelativeDeltaParams':
-        return {key: self.value_type(value) for key, value in groups.items() if value}
+    def _convert_match(self, match: Match, now: Optional[datetime] = None
+                       ) -> 'RelativeDeltaParams':
+        # Only look at our own groups rather than using groupdict(), which also allows
+        # converting matches of a Locale's combined regex.
+        names = self.group_names
+        values = match.group(*names)
+        if len(names) == 1:
+            # group() only returns a tuple when given multiple groups
+            values = (values,)
+        params = {}
+        for name, value in zip(names, values):
+            if value:
+                params[name] = self.value_type(value)
+        return params
 
 
 class TimeMatcher(RegexMatcher):
-    def _convert_match(self, match: Match) -> 'RelativeDeltaParams':
-        groups = match.groupdict()
-        try:
-            meridiem = groups.pop("meridiem").lower()
-        except (KeyError, AttributeError):
-            meridiem = None
-        params = self._convert_groups(groups)
+    __slots__ = ("has_meridiem",)
+
+    has_meridiem: bool
+
+    def __init__(self, pattern: str, value_type: Type = int_or_float) -> None:
+        super().__init__(pattern, value_type)
+        self.has_meridiem = "meridiem" in self.group_names
+        self.group_names = tuple(name for name in self.group_names if name != "meridiem")
+
+    def _convert_match(self, match: Match, now: Optional[datetime] = None
+                       ) -> 'RelativeDeltaParams':
+        meridiem = match.group("meridiem") if self.has_meridiem else None
+        if meridiem:
+            meridiem = meridiem.lower()
+        params = super()._convert_match(match, now)
         if meridiem == "pm":
             params["hour"] += 12
         elif meridiem == "am" and params["hour"] == 12:
@@ -107,10 +143,13 @@ class TimeMatcher(RegexMatcher):
 
 
 class ShortYearMatcher(RegexMatcher):
-    def _convert_match(self, match: Match) -> 'RelativeDeltaParams':
-        params = super()._convert_match(match)
-        if params["year"] < 100:
-            year = datetime.now().year
+    __slots__ = ()
+
+    def _convert_match(self, match: Match, now: Optional[datetime] = None
+                       ) -> 'RelativeDeltaParams':
+        params = super()._convert_match(match, now)
+        if "year" in params and params["year"] < 100:
+            year = (now or datetime.now()).year
             current_century = year // 100
             if params["year"] < year % 100:
                 current_century += 1
@@ -119,24 +158,35 @@ class ShortYearMatcher(RegexMatcher):
 
 
 class WeekdayMatcher(Matcher):
+    __slots__ = ("regex", "map", "substr")
+
     regex: Pattern
     map: Dict[str, Union[int, WeekdayType]]
     substr: int
 
     def __init__(self, pattern: str, map: Dict[str, Union[int, WeekdayType]], substr: int) -> None:
-        self.regex = re.compile(pattern, re.IGNORECASE)
-        self.map = map
+        self.regex = compile_pattern(pattern)
+        # Also include the usual capitalizations of the keys, so that lookups don't need to
+        # lowercase the input unless it has unusual casing.
+        self.map = {variant: value for key, value in map.items()
+                    for variant in (key.upper(), key.title(), key)}
         self.substr = substr
 
-    def match(self, val: str) -> Optional[MatcherReturn]:
+    def match(self, val: str, now: Optional[datetime] = None) -> Optional[MatcherReturn]:
         match = self.regex.match(val)
         if match and match.end() > 0:
-            weekday = self.map[match.string[:self.substr].lower()]
-            if isinstance(weekday, int):
-                weekday = (datetime.now().weekday() + weekday) % 7
-            return MatcherReturn(params={"weekday": weekday}, unconsumed=val[match.end():])
+            return MatcherReturn(self._convert_string(val, now), val[match.end():])
         return None
 
+    def _convert_string(self, val: str, now: Optional[datetime] = None) -> 'RelativeDeltaParams':
+        prefix = val[:self.substr]
+        weekday = self.map.get(prefix)
+        if weekday is None:
+            weekday = self.map[prefix.lower()]
+        if isinstance(weekday, int):
+            weekday = ((now or datetime.now()).weekday() + weekday) % 7
+        return {"weekday": weekday}
+
 
 class Locale(Matcher):
     name: str
@@ -153,30 +203,68 @@ class Locale(Matcher):
         self.weekday = weekday
         self.time = time
 
+    @functools.cached_property
+    def combined_regex(self) -> Optional[Pattern]:
+        # The combined regex is equivalent to trying the sub-matchers one by one like
+        # _match_separately() does, but only scans the input once. It's compiled on first use,
+        # as most users only use one or two of the locales.
+        if not (isinstance(self.timedelta, RegexMatcher) and isinstance(self.date, RegexMatcher)
+                and isinstance(self.weekday, WeekdayMatcher)
+                and isinstance(self.time, RegexMatcher)):
+            return None
+        try:
+            return compile_pattern(f"(?P<_timedelta>{self.timedelta.regex.pattern})"
+                                   f"|(?:(?P<_weekday>{self.weekday.regex.pattern})"
+                                   f"|(?P<_date>{self.date.regex.pattern}))?"
+                                   f"(?P<_time>{self.time.regex.pattern})?")
+        except re.error:
+            # e.g. the same group name being used in multiple sub-matchers
+            return None
+
     def replace(self, name: str, timedelta: Matcher = None, date: Matcher = None,
                 weekday: Matcher = None, time: Matcher = None) -> 'Locale':
         return Locale(name=name, timedelta=timedelta or self.timedelta, date=date or self.date,
                       weekday=weekday or self.weekday, time=time or self.time)
 
-    def match(self, val: str) -> Optional[MatcherReturn]:
-        found_delta = self.timedelta.match(val)
+    def match(self, val: str, now: Optional[datetime] = None) -> Optional[MatcherReturn]:
+        # Resolve the current time once so that all sub-matchers agree on it.
+        now = now or datetime.now()
+        if not self.combined_regex:
+            return self._match_separately(val, now)
+        match = self.combined_regex.match(val)
+        if not match or match.end() == 0:
+            return None
+        if match.group("_timedelta") is not None:
+            params = self.timedelta._convert_match(match, now)
+        else:
+            params = {}
+            if match.group("_weekday") is not None:
+                params = self.weekday._convert_string(val, now)
+            elif match.group("_date") is not None:
+                params = self.date._convert_match(match, now)
+            if match.group("_time") is not None:
+                params.update(self.time._convert_match(match, now))
+        return MatcherReturn(params, val[match.end():]) if params else None
+
+    def _match_separately(self, val: str, now: datetime) -> Optional[MatcherReturn]:
+        found_delta = self.timedelta.match(val, now)
         if found_delta:
             params, val = found_delta
         else:
             params = {}
-            found_day = self.weekday.match(val)
+            found_day = self.weekday.match(val, now)
             if found_day:
                 params, val = found_day
             else:
-                found_date = self.date.match(val)
+                found_date = self.date.match(val, now)
                 if found_date:
                     params, val = found_date
 
-            found_time = self.time.match(val)
+            found_time = self.time.match(val, now)
             if found_time:
-                params = {**params, **found_time.params}
+                params.update(found_time.params)
                 val = found_time.unconsumed
-        return MatcherReturn(params=params, unconsumed=val) if len(params) > 0 else None
+        return MatcherReturn(params, val) if len(params) > 0 else None
 
 
 Locales = Dict[str, Locale]
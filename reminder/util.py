@@ -14,19 +14,27 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from typing import Optional, Dict, List, Union, Tuple, TYPE_CHECKING
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from attr import dataclass
+import functools
+import calendar
 import re
 
-import pytz
 from dateutil.relativedelta import relativedelta
 
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
+except ImportError:
+    # Python 3.8, which maubot 0.4.1 still supports
+    from backports.zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
+
 from mautrix.types import UserID, RoomID, EventID
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 from maubot import MessageEvent
 from maubot.handlers.command import Argument, ArgumentSyntaxError
 
 from .locales import locales
+from .locale_util import Locale
 
 if TYPE_CHECKING:
     from .bot import ReminderBot
@@ -38,64 +46,86 @@ class Config(BaseProxyConfig):
         helper.copy("base_command")
 
 
+default_locales = (locales["en_iso"],)
+
+
+@functools.lru_cache(maxsize=1024)
+def resolve_locales(locale_ids: Tuple[str, ...]) -> Tuple[Locale, ...]:
+    return tuple(locales[id] for id in locale_ids if id in locales)
+
+
 class DateArgument(Argument):
     def __init__(self, name: str, label: str = None, *, required: bool = False):
         super().__init__(name, label=label, required=required, pass_raw=True)
 
     def match(self, val: str, evt: MessageEvent = None, instance: 'ReminderBot' = None
               ) -> Tuple[str, Optional[datetime]]:
-        tz = pytz.UTC
-        use_locales = [locales["en_iso"]]
+        tz = timezone.utc
+        use_locales = default_locales
         if instance:
             tz = instance.db.get_timezone(evt.sender, instance.default_timezone)
-            locale_ids = instance.db.get_locales(evt.sender)
-            use_locales = [locales[id] for id in locale_ids if id in locales]
+            use_locales = resolve_locales(tuple(instance.db.get_locales(evt.sender)))
 
+        now = datetime.now(tz=tz)
         for locale in use_locales:
-            match = locale.match(val)
+            match = locale.match(val, now)
             if match:
-                date = (datetime.now(tz=tz) + relativedelta(**match.params)).astimezone(pytz.UTC)
+                date = (now + relativedelta(**match.params)).astimezone(timezone.utc)
                 return match.unconsumed, date
         return val, None
 
 
-def parse_timezone(val: str) -> Optional[pytz.timezone]:
+@functools.lru_cache(maxsize=None)
+def timezone_keys() -> Dict[str, str]:
+    return {key.casefold(): key for key in available_timezones()}
+
+
+def load_timezone(name: str) -> ZoneInfo:
+    # pytz looked up zone names case-insensitively, so keep accepting e.g. "europe/helsinki"
+    try:
+        return ZoneInfo(name)
+    except ZoneInfoNotFoundError:
+        key = timezone_keys().get(name.casefold())
+        if not key:
+            raise
+        return ZoneInfo(key)
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_timezone(val: str) -> Optional[ZoneInfo]:
     if not val:
         return None
     try:
-        return pytz.timezone(val)
-    except pytz.UnknownTimeZoneError as e:
+        return load_timezone(val)
+    except (ZoneInfoNotFoundError, ValueError) as e:
         raise ArgumentSyntaxError(f"{val} is not a valid time zone.", show_usage=False) from e
 
 
-def pluralize(val: int, unit: str) -> str:
-    if val == 1:
-        return f"{val} {unit}"
-    return f"{val} {unit}s"
-
-
-def format_time(time: datetime) -> str:
-    now = datetime.now(tz=pytz.UTC).replace(microsecond=0)
-    if time - now <= timedelta(days=7):
-        delta = time - now
-        parts = []
-        if delta.days > 0:
-            parts.append(pluralize(delta.days, "day"))
-        hours, seconds = divmod(delta.seconds, 60)
-        hours, minutes = divmod(hours, 60)
-        if hours > 0:
-            parts.append(pluralize(hours, "hour"))
-        if minutes > 0:
-            parts.append(pluralize(minutes, "minute"))
-        if seconds > 0:
-            parts.append(pluralize(seconds, "second"))
+one_week = timedelta(days=7)
+# Singular and plural names of the units in relative times, indexed by whether the value != 1
+unit_names = (("day", "days"), ("hour", "hours"), ("minute", "minutes"), ("second", "seconds"))
+# calendar's name sequences call strftime on every access, so resolve them once
+day_names = tuple(calendar.day_name)
+month_names = tuple(calendar.month_name)
+
+
+def format_time(time: datetime, now: Optional[datetime] = None) -> str:
+    if now is None:
+        now = datetime.now(tz=timezone.utc).replace(microsecond=0)
+    delta = time - now
+    if delta <= one_week:
+        seconds = delta.seconds
+        values = (delta.days, seconds // 3600, seconds // 60 % 60, seconds % 60)
+        parts = [f"{value} {names[value != 1]}" for value, names in zip(values, unit_names)
+                 if value > 0]
         if len(parts) == 1:
             return "in " + parts[0]
         return "in " + ", ".join(parts[:-1]) + f" and {parts[-1]}"
-    return time.strftime("at %H:%M:%S %Z on %A, %B %-d %Y")
+    return (f"at {time.hour:02d}:{time.minute:02d}:{time.second:02d} {time.tzname() or ''} "
+            f"on {day_names[time.weekday()]}, {month_names[time.month]} {time.day} {time.year}")
 
 
-@dataclass
+@dataclass(slots=True)
 class ReminderInfo:
     id: int = None
     date: datetime = None